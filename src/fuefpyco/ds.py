@@ -6,22 +6,29 @@ Module contents:
    but rather finish what can be finished and collect all exceptions at the end.
 """
 
+import pickle
 from abc import abstractmethod
-from dataclasses import dataclass, replace
-from typing import Any, Generic, Iterable, Optional, Protocol, Type, TypeVar, runtime_checkable
+from dataclasses import dataclass, field
+from functools import reduce
+from operator import iadd
+from typing import Any, Generic, Iterable, Optional, Protocol, Type, TypeVar, get_origin
 
 from typing_extensions import Self
 
 
 # *** Monoid ***
-@runtime_checkable
 class Monoid(Protocol):
     """This simplifies applying map-reduce style processing logic. Imagine you have a list of urls of csvs you want
     to download and concat as a pandas. Or a list of dictionaries, each of which has some field 'k' you want to sum
     together. You can do that with for cycles, comprehensions, functools.reduce, ... Or, you can just define
     a dataclass that represents the result of a single computation, and how two computations can be put together
     (for the examples above, `pd.concat`, `+`), to satisfy the Monoid protocol, and then the `msum` function does
-    the rest for you."""
+    the rest for you.
+    Prefer constructing the sum directly, `type(self)(self.a + other.a)`, over `dataclasses.replace`, which goes
+    through field introspection on every call -- and `@dataclass(slots=True, frozen=True)` for small monoids.
+    Optionally, implement also the in-place `__iadd__` -- `msum` then accumulates everything into a single instance
+    obtained from `empty()`, which thus must return a fresh instance on every call. Immutable monoids, on the other
+    hand, can return a cached instance from `empty()`, e.g. via `functools.cache`."""
 
     @abstractmethod
     def __add__(self, other: Self) -> Self:
@@ -41,7 +48,28 @@ TMonoid = TypeVar("TMonoid", bound=Monoid)
 
 
 def msum(i: Iterable[TMonoid], t: Type[TMonoid]) -> TMonoid:
-    return sum(i, start=t.empty())
+    """Sums the monoids via a balanced pairwise reduction -- every element takes part in O(log n) additions instead
+    of O(n), which matters for monoids whose `__add__` copies the accumulated state (list concat, pd.concat, ...).
+    Monoids with in-place `__iadd__` are instead folded into a single accumulator, allocating nothing per element.
+    Relies on associativity only, the order of the elements is preserved."""
+    # NOTE parametrized types, such as `MaybeResult[X]`, are not classes themselves
+    if issubclass(get_origin(t) or t, MaybeResult):
+        return t.msum_maybe(i)  # type: ignore[attr-defined]
+    if hasattr(t, "__iadd__"):
+        return reduce(iadd, i, t.empty())
+    buf = list(i)
+    if not buf:
+        return t.empty()
+    return _tree_sum(buf)
+
+
+def _tree_sum(buf: list[TMonoid]) -> TMonoid:
+    while len(buf) > 1:
+        nxt = [buf[k] + buf[k + 1] for k in range(0, len(buf) - 1, 2)]
+        if len(buf) & 1:
+            nxt.append(buf[-1])
+        buf = nxt
+    return buf[0]
 
 
 @dataclass
@@ -51,14 +79,47 @@ class Failure:
 
     origin: str
     exception: Exception
+    _exc_str: str = field(init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        # NOTE cached since formatting the exception is not cheap, and eq/hash are called often when summing
+        self._exc_str = str(self.exception)
 
     def __eq__(self, other: Any) -> bool:
         # NOTE we override since `Exception`'s eq seems to be non cooperative with pickling
         if not isinstance(other, Failure):
             return False
-        if other.origin == self.origin and str(self.exception) == str(other.exception):
-            return True
-        return False
+        return self.origin == other.origin and self._exc_str == other._exc_str
+
+    def __hash__(self) -> int:
+        return hash((self.origin, self._exc_str))
+
+    def __reduce__(self) -> tuple:
+        # NOTE failures are created in workers and unpickled in the main process -- an exception which does not survive
+        # that (e.g., custom `__init__` signature, unpicklable attributes) would otherwise bring the whole computation
+        # down there. Thus the exception is pickled on its own, to be replaced by a plain one if it fails either way
+        try:
+            payload: Optional[bytes] = pickle.dumps(self.exception)
+        except Exception:
+            payload = None
+        return _unpickle_failure, (type(self), self.origin, payload, type(self.exception).__name__, self._exc_str)
+
+
+def _unpickle_failure(
+    cls: Type[Failure], origin: str, payload: Optional[bytes], exc_type: str, exc_str: str
+) -> Failure:
+    try:
+        exception = pickle.loads(payload) if payload is not None else None
+    except Exception:
+        exception = None
+    if exception is None:
+        exception = Exception(f"{exc_type}: {exc_str}")
+    # the original exception string is kept, so that the failure stays equal to the one before pickling
+    failure = cls.__new__(cls)
+    failure.origin = origin
+    failure.exception = exception
+    failure._exc_str = exc_str
+    return failure
 
 
 @dataclass
@@ -73,7 +134,29 @@ class MaybeResult(Generic[TMonoid]):
     def empty(cls) -> Self:
         return cls(result=None, failure=[])
 
+    @classmethod
+    def msum_maybe(cls, items: Iterable[Self]) -> Self:
+        """Bulk variant of `msum` -- all failures are collected into a single list, and only the non-empty results
+        get summed."""
+        buf = list(items)
+        # the failure list is allocated at its final size upfront, and filled by slices
+        failure: list[Failure] = [None] * sum(len(item.failure) for item in buf)  # type: ignore[list-item]
+        results: list[TMonoid] = []
+        offset = 0
+        for item in buf:
+            if item.failure:
+                failure[offset : offset + len(item.failure)] = item.failure
+                offset += len(item.failure)
+            if item.result is not None:
+                results.append(item.result)
+        return cls(result=_tree_sum(results) if results else None, failure=failure)
+
     def __add__(self, other: Self) -> Self:
+        # NOTE returning an operand as is relies on results not being mutated after being summed
+        if self.result is None and not self.failure:
+            return other
+        if other.result is None and not other.failure:
+            return self
         # annoyance due to python Optional not being well combinable. TODO improve
         if self.result is None and other.result is None:
             result = None
@@ -83,4 +166,4 @@ class MaybeResult(Generic[TMonoid]):
             result = self.result
         else:
             result = self.result + other.result
-        return replace(self, result=result, failure=self.failure + other.failure)
+        return type(self)(result=result, failure=self.failure + other.failure)
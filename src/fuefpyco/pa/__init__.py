@@ -8,12 +8,15 @@ of arguments, and the result being a monoid sum. The primary advantages over exi
    computation down. Note that if the function itself already returns MaybeResult, those get nested.
 
 There are multiple implementations, each with its own vices and virtues. In particular:
- - ProcessPerTask -- launches a new process for every task. Gives the most timeout-retry control, slowest, memory-safe.
- - ProcessPoolExecutor -- submits tasks to a process pool executor. Less control on timeouts, but faster.
+ - ProcessPerTask -- hands the tasks one by one to long-lived worker processes, replacing a worker only when its task
+   times out or crashes. Gives the most timeout control, with per-task timeouts, but a function leaking memory keeps
+   leaking across the tasks of a worker.
+ - ProcessPoolExecutor -- sends chunks of tasks to a process pool. Less control on timeouts, but faster.
 
 To use, instantiate the respective class, and feed it to the `mapreduce` function along with your `f` (the "map") and
 inputs (an iterable). The "reduce" part is given via the return value being a Monoid, with the summing happening
-usually in the main process.
+usually in the main process. The ProcessPoolExecutor keeps its pool of workers running across the `mapreduce` calls,
+until its `shutdown` -- preferably, use it as a context manager, `with ProcessPoolExecutor(config) as ppe: ...`.
 
 Additionally, both input and output class in the mapreduce must be serializable, as well as the `f` itself.
 """
@@ -1,11 +1,10 @@
-from typing import Callable, Iterable, Protocol, TypeVar, runtime_checkable
+from typing import Callable, Iterable, Protocol, TypeVar
 
 from fuefpyco.ds import MaybeResult, TMonoid
 
 T = TypeVar("T")
 
 
-@runtime_checkable
 class ComputationFactory(Protocol):
     """We bundle config and a factory to build the respective computation engine. This protocol handles the factory
     part."""
@@ -15,4 +14,7 @@ class ComputationFactory(Protocol):
 
 
 def mapreduce(f: Callable[[T], TMonoid], s: Iterable[T], c: ComputationFactory) -> MaybeResult[TMonoid]:
+    """Applies `f` on every element of `s` in parallel, and sums the results. Exceptions raised by `f` are collected as
+    failures of the result, with just their message -- the traceback is dropped already in the worker. If `f` fails
+    often, consider raising a pre-constructed exception instance instead of constructing a new one on every call."""
     return c.mapreduce(f, s)
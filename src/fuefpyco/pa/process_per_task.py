@@ -1,20 +1,28 @@
 """
-Implements MapReduce via vanilla processes. Every task is processed by exactly one process.
-Parallelism is by starting `n` processes at the start and giving each its own task, waiting for any to finish and
-starting new ones to keep the number of running `n`.
+Implements MapReduce via vanilla processes. Every task is processed by a single worker process at a time -- unless
+a speculative copy of it gets started, see below.
+Parallelism is by keeping `n` long-lived worker processes, each with its own input queue, handing a task to any idle
+worker and waiting for any to finish. A worker is only replaced by a fresh process when its task needs to be killed.
 
 Features:
- - timeout of a task (by killing the respective processes),
- - retry of a task (by re-submitting a new process),
-   - applies in the case of timeout or any exception thrown by the function. A case of non-zero exit of
-     the process with _any_ result returned is considered a success, and the non-zero exit code is provided
-     in a message in the `failure.origin` field,
+ - timeout of a task (by killing the respective worker process and starting a replacement),
+ - speculative execution -- once most of the tasks are finished, a task running way longer than is usual gets
+   a backup copy started on an idle worker, with the first copy to finish winning. The other copy is let finish (or
+   time out), with its result discarded, and is killed only once the whole computation is done,
+ - detection of a worker dying mid-task (segfault, oom kill, ...), reported as a failure of that task right away
+   instead of manifesting as a timeout,
+ - retry of a task (by re-submitting to a worker),
+   - applies in the case of timeout or any exception thrown by the function,
    - in case of a retry, the failure reason(s) are returned as well, with the attempt counter prepended to
      the `failure.origin` field.
- - low memory consumption (no risk of memory leak across multiple tasks),
- - slower throughput (has to start multiple processes),
+ - an initializer can be run at the start of every worker, e.g. to load heavy state just once. The timeout of the
+   first task of a worker starts only once the worker is initialized, so neither the initializer nor the import of
+   the modules of `f` count against it,
+ - process start cost is paid once per worker (plus once per timeout), not once per task. The flip side is that
+   a worker is reused across tasks, so a function leaking memory keeps leaking until the worker is killed,
  - mp.Queue is used to retrieve the results from local workers. In case of huge data volumes, this may bring some
-   troubles -- you may want to write disks instead, with the ipc being the file names only.
+   troubles -- set `result_transport` to "shm" to pickle the results into shared memory blocks, or to "file" to pickle
+   them into temporary files, with the queue then carrying just the block/file names.
 
 To use, instantiate the dataclass ProcessPerTask, with the config field containing all the tweakable behaviour, and
 pass to the core.mapreduce method.
@@ -24,17 +32,30 @@ pass to the core.mapreduce method.
 # TODO https://github.com/tmi/fuefpyco/issues/2 retries
 
 import logging
+import math
+import os
+import pickle
+import tempfile
 import time
+from bisect import insort
+from collections import Counter
 from dataclasses import dataclass
-from multiprocessing import Process, Queue, get_context
+from heapq import heappop, heappush
+from multiprocessing import Queue, get_context, resource_tracker
+from multiprocessing.connection import wait
+from multiprocessing.context import BaseContext
+from multiprocessing.process import BaseProcess
+from multiprocessing.shared_memory import SharedMemory
 from queue import Empty as EmptyQueueException
-from typing import Callable, Generic, Iterable, Iterator, Optional, TypeVar
+from typing import Callable, Generic, Iterable, Iterator, Literal, Optional, TypeVar, Union
 
 from fuefpyco.ds import Failure, MaybeResult, TMonoid
 
 logger = logging.getLogger(__name__)
 
-_process_join_grace = 3  # number of seconds we wait to join processes that returned. 0 should suffice
+_process_join_grace = 3  # number of seconds we wait to join processes that were asked to quit. 0 should suffice
+_speculation_finished_ratio = 0.9  # ratio of finished tasks after which stragglers are speculatively re-submitted
+_speculation_slowness = 2  # how many times longer than the median finished task must a straggler run
 
 
 @dataclass
@@ -43,7 +64,12 @@ class Config:
     task_timeout_s: int
     task_retries: int = 0
 
+    initializer: Optional[Callable[..., None]] = None
+    initargs: tuple = ()
+    speculative_execution: bool = False
+
     mp_context: str = "forkserver"
+    result_transport: Literal["queue", "shm", "file"] = "queue"
 
 
 T = TypeVar("T")
@@ -53,21 +79,210 @@ T = TypeVar("T")
 class _IntermediateResult(Generic[TMonoid]):
     result: MaybeResult[TMonoid]
     p_id: int
+    worker_id: int
+
+
+@dataclass
+class _Handoff:
+    """Sent over the queue instead of _IntermediateResult when the pickled result is transported out of band"""
+
+    p_id: int
+    worker_id: int
+    transport: str
+    location: str  # shared memory block name or file path
+    sizes: list[int]  # of the pickle stream, followed by sizes of the out-of-band buffers
+
+
+@dataclass
+class _Ready:
+    """Sent over the queue by a worker once initialized, before taking its first task"""
+
+    worker_id: int
+    pid: int
+
+
+@dataclass
+class _Worker:
+    p: BaseProcess
+    in_q: Queue
 
 
 @dataclass
 class _ProgressTracker(Generic[T]):
-    p: Process
+    p_id: int
     arg: T
-    submit_time_s: int
+    submit_time_s: float
+    started: bool = True  # False while waiting for a fresh worker to initialize, with the timeout not ticking yet
+    superseded: bool = False  # another copy of the task already finished, so the result of this one is discarded
+
+
+def _post(intermediate: _IntermediateResult, out_q: Queue, transport: str) -> None:
+    if transport == "queue":
+        out_q.put(intermediate)
+        return
+    # large contiguous data (numpy arrays, arrow-backed frames, ...) are given to us as out-of-band buffers, which we
+    # copy directly to the target instead of having them copied into the pickle stream first
+    buffers: list[pickle.PickleBuffer] = []
+    payload = pickle.dumps(intermediate, protocol=5, buffer_callback=buffers.append)
+    chunks = [memoryview(payload)] + [buffer.raw() for buffer in buffers]
+    sizes = [chunk.nbytes for chunk in chunks]
+    if transport == "shm":
+        shm = SharedMemory(create=True, size=max(sum(sizes), 1))
+        offset = 0
+        for chunk in chunks:
+            shm.buf[offset : offset + chunk.nbytes] = chunk  # type: ignore[index]
+            offset += chunk.nbytes
+        location = shm.name
+        shm.close()
+    elif transport == "file":
+        fd, location = tempfile.mkstemp(prefix="fuefpyco-")
+        with os.fdopen(fd, "wb") as fh:
+            for chunk in chunks:
+                fh.write(chunk)
+    else:
+        raise ValueError(f"unknown result transport {transport}")
+    out_q.put(_Handoff(intermediate.p_id, intermediate.worker_id, transport, location, sizes))
+
+
+def _receive(message: Union[_IntermediateResult, _Handoff]) -> _IntermediateResult:
+    """Also releases the shared memory block / file of the handoff."""
+    if isinstance(message, _IntermediateResult):
+        return message
+    raw = bytearray(sum(message.sizes))
+    if message.transport == "file":
+        with open(message.location, "rb") as fh:
+            fh.readinto(raw)
+        os.unlink(message.location)
+    else:
+        shm = SharedMemory(name=message.location)
+        with shm.buf[: len(raw)] as view:  # type: ignore[index]
+            raw[:] = view
+        shm.close()
+        shm.unlink()
+    # the out-of-band buffers are views into `raw`, so the unpickled data are not copied again
+    views = []
+    offset = 0
+    with memoryview(raw) as whole:
+        for size in message.sizes:
+            views.append(whole[offset : offset + size])
+            offset += size
+        return pickle.loads(views[0], buffers=views[1:])
 
 
-def _entrypoint(f: Callable[[T], TMonoid], arg: T, q: Queue, p_id: int):
+def _release(message: Union[_IntermediateResult, _Handoff, _Ready]) -> None:
+    """Releases the shared memory block / file of a handoff that is not going to be received."""
+    if not isinstance(message, _Handoff):
+        return
     try:
-        result = MaybeResult(f(arg), [])
-    except Exception as e:
-        result = MaybeResult(None, [Failure(f"failure with args {arg}", e)])
-    q.put(_IntermediateResult(result=result, p_id=p_id))
+        if message.transport == "file":
+            os.unlink(message.location)
+        else:
+            shm = SharedMemory(name=message.location)
+            shm.close()
+            shm.unlink()
+    except FileNotFoundError:
+        pass
+
+
+def _worker_loop(f_payload: Union[Callable[[T], TMonoid], bytes], in_q: Queue, out_q: Queue, worker_id: int, c: Config):
+    f = pickle.loads(f_payload) if isinstance(f_payload, bytes) else f_payload
+    if c.initializer is not None:
+        c.initializer(*c.initargs)
+    out_q.put(_Ready(worker_id, os.getpid()))
+    while True:
+        task = in_q.get()
+        if task is None:
+            break
+        p_id, arg = task
+        try:
+            result = MaybeResult(f(arg), [])
+        except Exception as e:
+            # NOTE the traceback does not survive pickling anyway, and would keep growing on a re-raised instance
+            result = MaybeResult(None, [Failure(f"failure with args {arg}", e.with_traceback(None))])
+        _post(_IntermediateResult(result=result, p_id=p_id, worker_id=worker_id), out_q, c.result_transport)
+
+
+def _start_worker(
+    f_payload: Union[Callable[[T], TMonoid], bytes], ctx: BaseContext, out_q: Queue, worker_id: int, c: Config
+) -> _Worker:
+    in_q = ctx.Queue()
+    args = (f_payload, in_q, out_q, worker_id, c)
+    p = ctx.Process(target=_worker_loop, args=args)  # type: ignore[attr-defined]
+    p.start()
+    logger.debug("started a worker with pid %s", p.pid)
+    return _Worker(p, in_q)
+
+
+def _stop_workers(workers: list[Optional[_Worker]]) -> None:
+    for worker in workers:
+        if worker is not None:
+            worker.in_q.put(None)
+    for worker in workers:
+        if worker is not None:
+            worker.p.join(_process_join_grace)
+            if worker.p.exitcode is None:
+                logger.warning("worker with pid %s failed to terminate, killing", worker.p.pid)
+                worker.p.kill()
+
+
+def _is_running(p_id: int, worker_id: int, running: list[Optional[_ProgressTracker]]) -> bool:
+    tracker = running[worker_id]
+    return tracker is not None and tracker.p_id == p_id
+
+
+def _complete(
+    intermediate: _IntermediateResult[TMonoid], running: list[Optional[_ProgressTracker]], idle: list[int]
+) -> Optional[_ProgressTracker]:
+    """Marks the task of the intermediate as finished and its worker as idle, returns the finished task.
+    Returns None if the result is to be discarded."""
+    tracker = running[intermediate.worker_id]
+    if tracker is None or tracker.p_id != intermediate.p_id:
+        # the worker managed to post the result right before being killed for a timeout
+        logger.debug("discarding a late result for %s", intermediate.p_id)
+        return None
+    running[intermediate.worker_id] = None
+    idle.append(intermediate.worker_id)
+    logger.debug("a result for %s processed", intermediate.p_id)
+    return tracker
+
+
+def _twin(p_id: int, running: list[Optional[_ProgressTracker]]) -> Optional[int]:
+    """The worker id of a still running copy of the task, in case of speculative execution."""
+    for worker_id, tracker in enumerate(running):
+        if tracker is not None and tracker.p_id == p_id:
+            return worker_id
+    return None
+
+
+def _next_straggler(
+    running: list[Optional[_ProgressTracker]], durations: list[float]
+) -> Optional[tuple[float, _ProgressTracker]]:
+    """The oldest task not having a copy yet, along with the time at which it becomes a straggler -- that is, when it
+    has been running way longer than the median finished task."""
+    if not durations:
+        return None
+    copies = Counter(tracker.p_id for tracker in running if tracker is not None)
+    candidates = [
+        tracker
+        for tracker in running
+        if tracker is not None and tracker.started and copies[tracker.p_id] == 1 and not tracker.superseded
+    ]
+    if not candidates:
+        return None
+    oldest = min(candidates, key=lambda tracker: tracker.submit_time_s)
+    return oldest.submit_time_s + _speculation_slowness * durations[len(durations) // 2], oldest
+
+
+def _kill(worker_id: int, workers: list[Optional[_Worker]]) -> Optional[_Worker]:
+    """Kills the worker, if started. The caller is to join it, the slot gets a new worker once needed again.
+    Note that a worker killed in the middle of posting its result may corrupt the shared result queue, or leave its lock
+    held -- a risk inherent to timeouts, but not to be taken for anything else while the computation runs."""
+    worker = workers[worker_id]
+    workers[worker_id] = None
+    if worker is not None:
+        logger.debug("killing worker %s with pid %s", worker_id, worker.p.pid)
+        worker.p.kill()
+    return worker
 
 
 def _mapreduce(f: Callable[[T], TMonoid], s: Iterable[T], c: Config) -> MaybeResult[TMonoid]:
@@ -76,69 +291,197 @@ def _mapreduce(f: Callable[[T], TMonoid], s: Iterable[T], c: Config) -> MaybeRes
     result: MaybeResult[TMonoid] = MaybeResult.empty()
     ctx = get_context(c.mp_context)
     queue = ctx.Queue()
+    # unless forking, every worker start pickles its args -- we pickle `f` just once and ship the bytes instead
+    f_payload = f if c.mp_context == "fork" else pickle.dumps(f)
+    if c.result_transport == "shm" and os.name == "posix":
+        # the blocks are created by the workers but unlinked by us -- the workers must thus share our resource tracker,
+        # which they inherit only if it is already running. Otherwise, a forked worker would start its own one, which
+        # would then "clean up" the already unlinked blocks once the worker exits
+        resource_tracker.ensure_running()
 
-    running: dict[int, _ProgressTracker] = {}
-    capacity: Callable[[], int] = lambda: c.parallelism - len(running)
+    # workers are started lazily, and a killed worker is replaced only once its slot is needed again. The slot index
+    # is the worker id, and indexes the task currently running on that worker as well
+    workers: list[Optional[_Worker]] = [None] * c.parallelism
+    running: list[Optional[_ProgressTracker]] = [None] * c.parallelism
+    idle = list(range(c.parallelism))
+    # min-heap of (submit_time_s, p_id, worker_id), entries of no longer running tasks are dropped lazily when on top
+    submits: list[tuple[float, int, int]] = []
+    n_running = 0  # busy workers, that is, including speculative copies
+    n_superseded = 0  # running copies whose result is going to be discarded
+    n_finished = 0
+    durations: list[float] = []  # of finished tasks, kept sorted
     it: Optional[Iterator[T]] = iter(s)
     p_id = 0
 
-    while True:
-        # maybe submit new process
-        if capacity() > 0 and it is not None:
-            try:
-                arg = next(it)
-            except StopIteration:
-                it = None
+    def dispatch(tracker: _ProgressTracker, speculative: bool) -> None:
+        worker_id = idle.pop()
+        worker = workers[worker_id]
+        if worker is None:
+            worker = workers[worker_id] = _start_worker(f_payload, ctx, queue, worker_id, c)
+            # the clock starts once the worker is ready -- except for a speculative copy, keeping that of the original
+            tracker.started = speculative
+        worker.in_q.put((tracker.p_id, tracker.arg))
+        running[worker_id] = tracker
+        if tracker.started:
+            heappush(submits, (tracker.submit_time_s, tracker.p_id, worker_id))
+        logger.debug("submitted a task #%s to worker %s", tracker.p_id, worker_id)
+
+    try:
+        while True:
+            # maybe submit new task
+            if n_running < c.parallelism and it is not None:
+                try:
+                    arg = next(it)
+                except StopIteration:
+                    it = None
+                    continue
+                dispatch(_ProgressTracker(p_id, arg, time.monotonic()), speculative=False)
+                n_running += 1
+                p_id += 1
                 continue
-            p = Process(target=_entrypoint, args=(f, arg, queue, p_id))
-            tracker = _ProgressTracker(p, arg, int(time.monotonic_ns() // 1e9))
-            running[p_id] = tracker
-            p.start()
-            logging.debug(f"submitted a process #{p_id} with pid p.pid")
-            p_id += 1
-            continue
-        # maybe quit
-        if capacity() == c.parallelism:
-            if running:
-                raise ValueError(f"internal error: expected no processes running, but {len(running)} entries remain")
-            logger.debug("all processes completed, breaking main loop")
-            break
-        # wait for next result
-        oldest_submit = min(e.submit_time_s for e in running.values())
-        next_timeout = oldest_submit + c.task_timeout_s
-        current_time = time.monotonic_ns() // 1e9
-        if next_timeout > current_time:
-            try:
+            # maybe submit a copy of a straggler -- keeping the original submit time, so that both time out together
+            speculation: Optional[tuple[float, _ProgressTracker]] = None
+            if (
+                c.speculative_execution
+                and it is None
+                and n_running < c.parallelism
+                and n_finished >= _speculation_finished_ratio * p_id
+            ):
+                speculation = _next_straggler(running, durations)
+                if speculation is not None and speculation[0] <= time.monotonic():
+                    straggler = speculation[1]
+                    logger.debug("speculatively re-submitting a straggling task #%s", straggler.p_id)
+                    dispatch(_ProgressTracker(straggler.p_id, straggler.arg, straggler.submit_time_s), speculative=True)
+                    n_running += 1
+                    continue
+            # maybe quit -- not waiting for the superseded copies
+            if n_running == n_superseded:
+                remaining = sum(e is not None and not e.superseded for e in running)
+                if remaining > 0:
+                    raise ValueError(f"internal error: expected no tasks running, but {remaining} entries remain")
+                logger.debug("all tasks completed, breaking main loop")
+                break
+            # wait for next result
+            while submits and not _is_running(submits[0][1], submits[0][2], running):
+                heappop(submits)
+            # with no clock started yet, we wait just for the workers to get ready
+            next_timeout = submits[0][0] + c.task_timeout_s if submits else math.inf
+            current_time = time.monotonic()
+            if next_timeout > current_time:
                 wait_time = next_timeout - current_time
-                logger.debug(f"about to wait for {wait_time} seconds for a result")
-                intermediate = queue.get(timeout=wait_time)
-                tracker = running.pop(intermediate.p_id)
-                tracker.p.join(_process_join_grace)
-                exitcode = tracker.p.exitcode
-                if exitcode is None:
-                    raise ValueError(f"process {tracker.p.pid} with arg {tracker.arg} failed to terminate")
-                if exitcode != 0:
-                    nonzero: MaybeResult[TMonoid] = MaybeResult(
-                        None, [Failure(f"non-zero exit code {exitcode} with arg {tracker.arg}", Exception())]
+                if speculation is not None:
+                    # wake up in time to speculate on the oldest task not having a copy yet
+                    wait_time = max(min(wait_time, speculation[0] - current_time), 0)
+                logger.debug("about to wait for %s seconds for a result", wait_time)
+                # a single wait both for a result arriving, and for any worker exiting -- portable, unlike selectors,
+                # since on Windows neither the pipe nor the sentinels are sockets
+                sentinels = {worker.p.sentinel: worker_id for worker_id, worker in enumerate(workers) if worker}
+                timeout = wait_time if wait_time != math.inf else None
+                events = wait([queue._reader, *sentinels], timeout=timeout)  # type: ignore[attr-defined]
+                if not events:
+                    logger.debug("wait unsuccessful")
+                    if next_timeout > time.monotonic():
+                        continue
+                else:
+                    # process all the results which arrived meanwhile, before getting back to submitting
+                    while True:
+                        try:
+                            message = queue.get_nowait()
+                        except EmptyQueueException:
+                            break
+                        if isinstance(message, _Ready):
+                            ready = running[message.worker_id]
+                            worker = workers[message.worker_id]
+                            if ready is not None and not ready.started and worker and worker.p.pid == message.pid:
+                                logger.debug(
+                                    "worker %s ready, starting the clock of #%s", message.worker_id, ready.p_id
+                                )
+                                ready.started = True
+                                ready.submit_time_s = time.monotonic()
+                                heappush(submits, (ready.submit_time_s, ready.p_id, message.worker_id))
+                            continue
+                        intermediate = _receive(message)
+                        finished = _complete(intermediate, running, idle)
+                        if finished is None:
+                            continue
+                        n_running -= 1
+                        if finished.superseded:
+                            n_superseded -= 1
+                            continue
+                        n_finished += 1
+                        insort(durations, time.monotonic() - finished.submit_time_s)
+                        result = result + intermediate.result
+                        if c.speculative_execution and (twin_id := _twin(finished.p_id, running)) is not None:
+                            # not killed, see `_kill` -- the other copy runs on until it finishes or times out
+                            logger.debug("a copy of task #%s finished first, superseding the other one", finished.p_id)
+                            twin = running[twin_id]
+                            if twin is not None:
+                                twin.superseded = True
+                                n_superseded += 1
+                    # workers that exited -- with all results drained, a task still running on them is lost
+                    for event in events:
+                        # sentinels are ints, unlike the queue's pipe
+                        if not isinstance(event, int) or workers[sentinels[event]] is None:
+                            continue
+                        dead_id = sentinels[event]
+                        dead = _kill(dead_id, workers)
+                        if dead is not None:
+                            dead.p.join(_process_join_grace)
+                            logger.debug("worker %s with pid %s exited with %s", dead_id, dead.p.pid, dead.p.exitcode)
+                        lost = running[dead_id]
+                        if lost is not None:
+                            running[dead_id] = None
+                            n_running -= 1
+                            idle.append(dead_id)
+                            if lost.superseded:
+                                n_superseded -= 1
+                            elif _twin(lost.p_id, running) is None:
+                                n_finished += 1
+                                exitcode = dead.p.exitcode if dead is not None else None
+                                obituary: MaybeResult[TMonoid] = MaybeResult(
+                                    None,
+                                    [Failure(f"worker exited with code {exitcode} with arg {lost.arg}", Exception())],
+                                )
+                                result = result + obituary
+                    continue
+            # kill all the tasks that have timed out -- they are at the top of the heap
+            convicts: list[Optional[_Worker]] = []
+            current_time = time.monotonic()
+            while submits and submits[0][0] + c.task_timeout_s <= current_time:
+                _, k_id, k_worker_id = heappop(submits)
+                if not _is_running(k_id, k_worker_id, running):
+                    continue
+                convict_tracker = running[k_worker_id]
+                running[k_worker_id] = None
+                n_running -= 1
+                idle.append(k_worker_id)
+                logger.debug("task #%s on worker %s timed out", k_id, k_worker_id)
+                convicts.append(_kill(k_worker_id, workers))
+                # a speculative copy, if any, has the same submit time and is thus about to be popped as well
+                if convict_tracker is not None and convict_tracker.superseded:
+                    n_superseded -= 1
+                elif convict_tracker is not None and _twin(k_id, running) is None:
+                    n_finished += 1
+                    sentence: MaybeResult[TMonoid] = MaybeResult(
+                        None, [Failure(f"timed out with arg {convict_tracker.arg}", Exception())]
                     )
-                    intermediate.result = intermediate.result + nonzero
-                result = result + intermediate.result
-                logger.debug(f"a result for {intermediate.p_id} processed")
-                continue
+                    result = result + sentence
+            for convict in convicts:
+                if convict is not None:
+                    convict.p.join(_process_join_grace)
+    finally:
+        # the superseded copies are not waited for -- with the queue not being read anymore, a kill can no longer
+        # corrupt anything
+        for worker_id, tracker in enumerate(running):
+            if tracker is not None and tracker.superseded and (abandoned := _kill(worker_id, workers)) is not None:
+                abandoned.p.join(_process_join_grace)
+        _stop_workers(workers)
+        # results of killed or interrupted tasks may still sit in the queue, holding shared memory blocks / files. The
+        # handoffs are small enough to be written atomically, so even a killed worker left no partial one behind
+        while c.result_transport != "queue":
+            try:
+                _release(queue.get_nowait())
             except EmptyQueueException:
-                logger.debug("wait unsuccessful")
-                pass
-        # kill
-        for p_id in running:
-            logger.debug(f"inspecting process #{p_id}")
-            if running[p_id].submit_time_s < next_timeout:
-                convict = running.pop(p_id)
-                sentence: MaybeResult[TMonoid] = MaybeResult(
-                    None, [Failure(f"timed out with arg {convict.arg}", Exception())]
-                )
-                result = result + sentence
-                logger.debug(f"killing process #{p_id} with pid {convict.p.pid}")
-                convict.p.kill()
                 break
     return result
 
@@ -1,30 +1,55 @@
 """
-Implements MapReduce via ProcessPoolExecutor's submit.
+Implements MapReduce via multiprocessing Pool's apply_async, with a bounded number of tasks in flight.
 
 Features:
  - you can control the size of the pool (and thus the parallelism),
  - you can control max_tasks_per_child (how many tasks a process solves until recycled),
-   - actually not supported until Python 3.11
- - you can specify retry count per task,
- - you can specify *total* timeout -- but not timeout per task.
+ - you can control the chunksize (how many tasks are sent to a worker at once) -- by default derived from the input
+   length, which is however unknown for e.g. generators,
+ - you can specify retry count per task -- retries happen right away in the same worker,
+ - you can specify *total* timeout -- but not timeout per task,
+ - you can ask to fail fast -- the first task failing (after its retries) stops the computation, and the result summed
+   so far is returned, along with the failure. The remaining tasks of the respective chunk are not even started,
+ - you can specify an initializer to be run at the start of every worker, e.g. to load heavy state just once,
+ - you can ask for a tree reduce -- the chunk results are then summed in a second stage in the workers, each summing
+   a share of them, instead of being folded one by one in the main process. Worth it for expensive `__add__` only.
+
+The function of the first mapreduce is installed in the workers when the pool starts, so the subsequent tasks using it
+carry just their arguments. Other functions get shipped along with every chunk of tasks.
 
 This is somehow faster than ProcessPerTask (unless you set max_tasks_per_child=1, in which case they become the ~same)
-thanks to less processes being started in total. You pay for that by being punished by possible memory leaks, as well
-as inability to control timeout for individual task execution.
+thanks to less processes being started in total, and tasks being sent to workers in chunks. Every chunk is summed
+already in the worker, so a single result per chunk travels back, and those are summed as they arrive, in no particular
+order. You pay for that by being punished by possible memory leaks, as well as inability to control timeout for
+individual task execution.
 
 To use, instantiate the dataclass ProcessPoolExecutor, with the config field containing all the tweakable behaviour, and
-pass to the core.mapreduce method.
+pass to the core.mapreduce method. The pool is started on the first mapreduce and then reused by subsequent calls, until
+`shutdown` (or the garbage collection of the ProcessPoolExecutor) -- so preferably use it as a context manager:
+```
+with ProcessPoolExecutor(Config(parallelism=4)) as ppe:
+    first = mapreduce(f, s1, ppe)
+    second = mapreduce(g, s2, ppe)
+```
 """
 
 import multiprocessing as mp
+import sys
+import threading
 import time
-from concurrent.futures import FIRST_EXCEPTION, Future
-from concurrent.futures import ProcessPoolExecutor as PPE
-from concurrent.futures import wait
-from dataclasses import dataclass
+import weakref
+from dataclasses import dataclass, field
+from functools import partial
+from itertools import islice
+from multiprocessing.pool import Pool
+from operator import length_hint
+from queue import Empty, SimpleQueue
 from typing import Any, Callable, Iterable, Optional, TypeVar
 
+from typing_extensions import Self
+
 from fuefpyco.ds import Failure, MaybeResult, TMonoid
+from fuefpyco.it import windows
 
 
 @dataclass
@@ -33,65 +58,201 @@ class Config:
     max_tasks_per_child: Optional[int] = None  # None for unlimited
     task_retries: int = 0
     total_timeout_s: Optional[int] = None  # None for unlimited
+    initializer: Optional[Callable[..., None]] = None
+    initargs: tuple = ()
+    fail_fast: bool = False
+    tree_reduce: bool = False
+    chunksize: Optional[int] = None  # None to derive from the input length, if known
 
-    mp_context: str = "forkserver"
+    mp_context: Optional[str] = None  # None for fork where safe, see `_default_mp_context`
 
 
 T = TypeVar("T")
 
+_chunks_in_flight_per_worker = 2  # the input is pulled only as fast as the chunks get completed
+
+
+_installed_f: Optional[Callable] = None
+_init_failure: Optional[Exception] = None
+
+
+def _default_mp_context(c: Config) -> str:
+    # NOTE forking spares every worker the re-import of the modules, which spawn and forkserver pay. But forking
+    # a multi-threaded process may deadlock the child -- so we fork only if the calling process has no other threads
+    # when the pool starts. The pool forks its initial workers before starting its own threads, yet it replaces every
+    # exited worker by forking from its handler thread -- which is what max_tasks_per_child does all the time, so we
+    # don't fork then at all. Also, forking is considered unsafe on macOS due to the system frameworks, and is
+    # unavailable on Windows
+    if not sys.platform.startswith("linux"):
+        return "spawn"
+    if c.max_tasks_per_child is None and threading.active_count() == 1:
+        return "fork"
+    return "forkserver"
+
+
+def _init_worker(f: Callable, initializer: Optional[Callable[..., None]], initargs: tuple) -> None:
+    global _installed_f, _init_failure
+    _installed_f = f
+    if initializer is not None:
+        # NOTE a worker dying here would just get restarted by the pool, over and over, with no task ever completing.
+        # So we keep it alive, and report the failure for every task it gets
+        try:
+            initializer(*initargs)
+        except Exception as e:
+            _init_failure = e.with_traceback(None)
+
+
+def _attempt_chunk(
+    f: Callable[[T], TMonoid], retries: int, fail_fast: bool, chunk: list[T]
+) -> tuple[MaybeResult[TMonoid], bool]:
+    """Runs in the worker, summing the results of the whole chunk so that just a single result gets sent back.
+    The flag tells whether any task failed even after all the retries."""
+    if _init_failure is not None:
+        return (
+            MaybeResult(None, [Failure(f"initializer failure with args {arg}", _init_failure) for arg in chunk]),
+            True,
+        )
+    attempts = []
+    failed = False
+    for arg in chunk:
+        attempt = _attempt(f, retries, arg)
+        attempts.append(attempt)
+        if len(attempt.failure) > retries:
+            failed = True
+            if fail_fast:
+                break
+    return MaybeResult.msum_maybe(attempts), failed
+
+
+def _attempt_chunk_installed(retries: int, fail_fast: bool, chunk: list[T]) -> tuple[MaybeResult, bool]:
+    if _installed_f is None:
+        raise ValueError("internal error: no function installed in the worker")
+    return _attempt_chunk(_installed_f, retries, fail_fast, chunk)
 
-def _mapreduce(f: Callable[[T], TMonoid], s: Iterable[T], c: Config) -> MaybeResult[TMonoid]:
-    start_time = time.monotonic_ns() // 1e9
-    tasks: dict[Future, tuple[T, list[Failure]]] = {}
+
+def _attempt(f: Callable[[T], TMonoid], retries: int, arg: T) -> MaybeResult[TMonoid]:
+    """Runs in the worker. Exceptions are captured as failures, so that nothing gets re-raised in the main process."""
+    failures: list[Failure] = []
+    while True:
+        try:
+            return MaybeResult(f(arg), failures)
+        except Exception as e:
+            # NOTE the traceback does not survive pickling anyway, and would keep growing on a re-raised instance
+            failures.append(Failure(f"failure with args {arg}", e.with_traceback(None)))
+            if len(failures) > retries:
+                return MaybeResult(None, failures)
+
+
+def _mapreduce(
+    f: Callable[[T], TMonoid], s: Iterable[T], c: Config, pool: Pool, installed: bool
+) -> tuple[MaybeResult[TMonoid], bool]:
+    """Returns also whether the computation was cut short due to fail fast"""
+    deadline = time.monotonic() + c.total_timeout_s if c.total_timeout_s else None
     result: MaybeResult[TMonoid] = MaybeResult.empty()
-    running = 0
-    # TODO after python 3.11, enable this in the PPE call:
-    # max_tasks_per_child = c.max_tasks_per_child
-    if c.max_tasks_per_child:
-        raise ValueError("max_tasks_per_child supported only after python 3.11")
-    ctx = mp.get_context(c.mp_context)
-    with PPE(max_workers=c.parallelism, mp_context=ctx) as ppe:
-        for t in s:
-            future: Future = ppe.submit(f, t)
-            tasks[future] = (
-                t,
-                [],
-            )
-            running += 1
-
-        while running > 0:
-            if c.total_timeout_s:
-                elapsed_s = (time.monotonic_ns() // 1e9) - start_time
-                timeout = c.total_timeout_s - elapsed_s
-                if timeout <= 0:
-                    break
-            else:
-                timeout = None
-            # Any because wait is probably not properly annotated
-            intermediate: Any = wait(tasks.keys(), timeout=timeout, return_when=FIRST_EXCEPTION)
-            for e in intermediate.done:
-                if e.exception():
-                    previous = tasks.pop(e)
-                    if len(previous[1]) < c.task_retries:
-                        future = ppe.submit(f, previous[0])
-                        tasks[future] = (
-                            previous[0],
-                            previous[1] + [Failure(f"failure of arg {previous[0]}", e.exception())],
-                        )
-                else:
-                    previous = tasks.pop(e)
-                    result = result + MaybeResult(e.result(), previous[1])
-                    running -= 1
-
-        if running > 0:
+    # NOTE bigger chunks mean less ipc roundtrips, smaller chunks mean better balancing among workers. Unsized inputs
+    # are sent one by one, unless the chunksize is configured
+    chunksize = c.chunksize or max(1, length_hint(s) // (4 * c.parallelism))
+    if installed:
+        task = partial(_attempt_chunk_installed, c.task_retries, c.fail_fast)
+    else:
+        task = partial(_attempt_chunk, f, c.task_retries, c.fail_fast)
+    # NOTE unlike imap_unordered, which eagerly drains the whole input into the task queue, we keep only a bounded
+    # number of chunks in flight, and submit the next one once a result arrives -- so memory stays bounded for large
+    # inputs
+    chunks = iter(windows(s, chunksize))
+    # filled from the pool's result handler thread, with either a (result, failed) pair or an exception
+    outcomes: SimpleQueue = SimpleQueue()
+    in_flight = 0
+    for chunk in islice(chunks, _chunks_in_flight_per_worker * c.parallelism):
+        pool.apply_async(task, (chunk,), callback=outcomes.put, error_callback=outcomes.put)
+        in_flight += 1
+    partials: list[MaybeResult[TMonoid]] = []
+    while in_flight > 0:
+        try:
+            outcome = outcomes.get(timeout=_remaining(deadline))
+        except Empty:
             raise TimeoutError("total timeout elapsed yet some tasks are still running")
+        in_flight -= 1
+        if isinstance(outcome, BaseException):
+            # e.g. the result failed to pickle
+            raise outcome
+        partial_result, failed = outcome
+        if c.tree_reduce:
+            partials.append(partial_result)
+        else:
+            result = result + partial_result
+        if failed and c.fail_fast:
+            return result + MaybeResult.msum_maybe(partials), True
+        for chunk in islice(chunks, 1):
+            pool.apply_async(task, (chunk,), callback=outcomes.put, error_callback=outcomes.put)
+            in_flight += 1
+
+    if len(partials) > c.parallelism:
+        # second stage: every worker sums a contiguous share of the partials, and just those sums are summed here
+        shares = windows(partials, -(-len(partials) // c.parallelism))
+        try:
+            partials = pool.map_async(MaybeResult.msum_maybe, shares).get(timeout=_remaining(deadline))
+        except mp.TimeoutError:
+            raise TimeoutError("total timeout elapsed yet some partial results are still being summed")
+    return result + MaybeResult.msum_maybe(partials), False
+
 
-    return result
+def _remaining(deadline: Optional[float]) -> Optional[float]:
+    return max(deadline - time.monotonic(), 0) if deadline is not None else None
 
 
 @dataclass
 class ProcessPoolExecutor:
     config: Config
+    _pool: Optional[Pool] = field(default=None, init=False, repr=False, compare=False)
+    _pool_f: Optional[Callable] = field(default=None, init=False, repr=False, compare=False)
+    # terminates the pool once the executor gets garbage collected without `shutdown`
+    _finalizer: Optional[weakref.finalize] = field(default=None, init=False, repr=False, compare=False)
 
     def mapreduce(self, f: Callable[[T], TMonoid], s: Iterable[T]) -> MaybeResult[TMonoid]:
-        return _mapreduce(f, s, self.config)
+        if self._pool is None:
+            c = self.config
+            ctx = mp.get_context(c.mp_context or _default_mp_context(c))
+            self._pool = ctx.Pool(
+                processes=c.parallelism,
+                maxtasksperchild=c.max_tasks_per_child,
+                initializer=_init_worker,
+                initargs=(f, c.initializer, c.initargs),
+            )
+            self._pool_f = f
+            self._finalizer = weakref.finalize(self, self._pool.terminate)
+        try:
+            result, interrupted = _mapreduce(f, s, self.config, self._pool, f is self._pool_f)
+        except BaseException:
+            # timeout, interrupt, unpicklable result, ... -- the chunks in flight must not occupy the reused pool
+            self._terminate()
+            raise
+        if interrupted:
+            self._terminate()
+        return result
+
+    def _terminate(self) -> None:
+        # the tasks still running would otherwise occupy the pool for the subsequent calls
+        if self._pool is not None:
+            self._pool.terminate()
+            self._forget_pool()
+
+    def shutdown(self) -> None:
+        """Waits for the workers to finish, and stops them. A subsequent mapreduce starts a new pool."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._forget_pool()
+
+    def _forget_pool(self) -> None:
+        if self._finalizer is not None:
+            self._finalizer.detach()
+        self._pool = None
+        self._pool_f = None
+        self._finalizer = None
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.shutdown()
@@ -1,22 +1,41 @@
+import pickle
 from dataclasses import dataclass, replace
+from functools import cache
 
 from typing_extensions import Self
 
 from fuefpyco.ds import Failure, MaybeResult, msum
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class AMonoid:
     a: int
 
     def __add__(self, other: Self) -> Self:
-        return replace(self, a=self.a + other.a)
+        return type(self)(self.a + other.a)
 
     @classmethod
+    @cache
     def empty(cls) -> Self:
         return cls(0)
 
 
+@dataclass
+class LMonoid:
+    ls: list[int]
+
+    def __add__(self, other: Self) -> Self:
+        return replace(self, ls=self.ls + other.ls)
+
+    def __iadd__(self, other: Self) -> Self:
+        self.ls.extend(other.ls)
+        return self
+
+    @classmethod
+    def empty(cls) -> Self:
+        return cls([])
+
+
 def test_monoid() -> None:
     l1 = [AMonoid(4), AMonoid(5)]
     l2: list[AMonoid] = []
@@ -24,6 +43,20 @@ def test_monoid() -> None:
     assert msum(l2, AMonoid) == AMonoid(a=0)
 
 
+def test_monoid_inplace() -> None:
+    l1 = [LMonoid([1]), LMonoid([2, 3])]
+    assert msum(l1, LMonoid) == LMonoid([1, 2, 3])
+    assert l1 == [LMonoid([1]), LMonoid([2, 3])]
+    assert msum([], LMonoid) == LMonoid([])
+
+
+def test_msum_preserves_order() -> None:
+    failures: list[MaybeResult] = [
+        MaybeResult(result=None, failure=[Failure(origin=str(i), exception=ValueError())]) for i in range(7)
+    ]
+    assert [f.origin for f in msum(failures, MaybeResult).failure] == [str(i) for i in range(7)]
+
+
 def test_maybe_result() -> None:
     succ1 = MaybeResult(result=AMonoid(a=4), failure=[])
     fail1 = MaybeResult(result=AMonoid.empty(), failure=[Failure(origin="a", exception=ValueError())])
@@ -32,3 +65,27 @@ def test_maybe_result() -> None:
     all_r = msum([succ1, fail1, succ2, fail2], MaybeResult)
     assert all_r.result == AMonoid(a=9)
     assert all_r.failure == [fail1.failure[0], fail2.failure[0]]
+    assert msum([succ1, fail1], MaybeResult[AMonoid]) == msum([succ1, fail1], MaybeResult)
+
+
+def test_failure_eq() -> None:
+    f1 = Failure(origin="a", exception=ValueError("x"))
+    f2 = Failure(origin="a", exception=ValueError("x"))
+    f3 = Failure(origin="a", exception=ValueError("y"))
+    assert f1 == f2
+    assert f1 != f3
+    assert len({f1, f2, f3}) == 2
+
+
+class UnpicklableError(Exception):
+    def __init__(self, a: int, b: int) -> None:
+        super().__init__(f"{a} and {b}")
+
+
+def test_failure_pickle() -> None:
+    f1 = Failure(origin="a", exception=ValueError("x"))
+    assert pickle.loads(pickle.dumps(f1)) == f1
+    f2 = Failure(origin="a", exception=UnpicklableError(1, 2))
+    f2_unpickled = pickle.loads(pickle.dumps(f2))
+    assert f2_unpickled == f2
+    assert str(f2_unpickled.exception) == "UnpicklableError: 1 and 2"
@@ -1,4 +1,4 @@
-from fuefpyco.it import consume, flatmap, fold_transform, unzip, windows
+from fuefpyco.it import compose, consume, flatmap, fold_transform, lazy_unzip, unzip, windows
 
 
 def test_flatmap() -> None:
@@ -15,12 +15,25 @@ def test_fold_transform() -> None:
     assert fold_transform(2, pipeline) == 6
 
 
+def test_compose() -> None:
+    pipeline = [
+        lambda a: a + 1,
+        lambda a: a * 2,
+    ]
+    composed = compose(iter(pipeline))
+    assert composed(2) == 6
+    assert composed(3) == 8
+
+
 def test_unzip() -> None:
     l1 = [1, 2, 3]
     l2 = ["a", "b", "c"]
     zl = zip(l1, l2)
     rl1, rl2 = unzip(zl)
     assert (list(rl1), list(rl2)) == (l1, l2)
+    assert unzip([]) == ((), ())
+    ll1, ll2 = lazy_unzip(zip(l1, l2))
+    assert (list(ll1), list(ll2)) == (l1, l2)
 
 
 def test_consume() -> None:
@@ -33,13 +46,14 @@ def test_consume() -> None:
     body, li = consume(li, 2)
     assert body == [2, 3]
     assert list(li) == [4, 5]
+    head, rest = consume(ls, 2)
+    assert (head, list(rest)) == ([1, 2], [3, 4, 5])
 
 
 def test_windows() -> None:
     ls = [1, 2, 3, 4, 5]
-    badly_consumed = list(windows(ls, 2))
-    badly_consumed_eval = [list(e) for e in badly_consumed]
-    assert badly_consumed_eval == [[1], [2], [3], [4], [5]]
+    assert list(windows(ls, 2)) == [[1, 2], [3, 4], [5]]
+    assert list(windows([], 2)) == []
     well_consumed = []
     for window in windows(ls, 2):
         well_consumed.append(list(window))
@@ -1,20 +1,28 @@
-import logging
-from dataclasses import dataclass, replace
+import os
+import tempfile
+import time
+from dataclasses import dataclass
+from functools import cache
+from itertools import count
+from multiprocessing.connection import wait
 
+import pytest
 from typing_extensions import Self
 
 from fuefpyco.ds import Failure, msum
-from fuefpyco.pa import PPEConfig, PPTConfig, ProcessPerTask, ProcessPoolExecutor, mapreduce
+from fuefpyco.pa import PPEConfig, PPTConfig, ProcessPerTask, ProcessPoolExecutor, mapreduce, process_per_task
+from fuefpyco.pa.process_pool_executor import _attempt
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class AMonoid:
     a: int
 
     def __add__(self, other: Self) -> Self:
-        return replace(self, a=self.a + other.a)
+        return type(self)(self.a + other.a)
 
     @classmethod
+    @cache
     def empty(cls) -> Self:
         return cls(0)
 
@@ -28,23 +36,81 @@ def simple_f(a: int):
     return AMonoid(a=a * 2)
 
 
-def test_mapreduce_happy():
-    logging.basicConfig(level="DEBUG", force=True)
+def slow_f(a: int):
+    if a > 9:
+        time.sleep(a)
+    return AMonoid(a=a * 2)
+
+
+def crashing_f(a: int):
+    if a > 9:
+        os._exit(a)
+    return AMonoid(a=a * 2)
+
+
+_attempted: set[int] = set()
+
+
+def flaky_f(a: int):
+    if a not in _attempted:
+        _attempted.add(a)
+        raise _error
+    return AMonoid(a=a * 2)
+
+
+_offset = 0
+
+
+def set_offset(offset: int):
+    global _offset
+    _offset = offset
+
+
+def slow_set_offset(offset: int):
+    time.sleep(1.5)
+    set_offset(offset)
+
+
+def failing_init():
+    raise _error
+
+
+def offset_f(a: int):
+    return AMonoid(a=a + _offset)
+
 
+def sleepy_f(a: int):
+    if a > 9:
+        raise _error
+    time.sleep(0.05)
+    return AMonoid(a=a * 2)
+
+
+def straggling_f(arg: tuple[int, str]):
+    # only the first attempt straggles -- the marker file is shared by all the workers
+    a, marker = arg
+    if a > 9 and not os.path.exists(marker):
+        open(marker, "w").close()
+        time.sleep(10)
+    return AMonoid(a=a * 2)
+
+
+def interrupted_seq():
+    yield 1
+    yield 2
+    raise _error
+
+
+def test_mapreduce_happy():
     input_seq = [1, 2, 3]
     expected = msum((simple_f(e) for e in input_seq), AMonoid)
 
     # succ
-    ppt = ProcessPerTask(PPTConfig(parallelism=4, task_timeout_s=1))
+    ppt = ProcessPerTask(PPTConfig(parallelism=4, task_timeout_s=10))
     ppt_result = mapreduce(simple_f, input_seq, ppt)
     assert ppt_result.result == expected
     assert ppt_result.failure == []
 
-    ppe = ProcessPoolExecutor(PPEConfig(parallelism=4))
-    ppe_result = mapreduce(simple_f, input_seq, ppe)
-    assert ppe_result.result == expected
-    assert ppe_result.failure == []
-
     # succ + fail
     seq_with_error = [1, 2, 10]
     expected_succ = msum((simple_f(e) for e in seq_with_error[:2]), AMonoid)
@@ -54,6 +120,190 @@ def test_mapreduce_happy():
     assert ppt_result.result == expected_succ
     assert ppt_result.failure == expected_fail
 
-    ppe_result = mapreduce(simple_f, seq_with_error, ppt)
-    assert ppe_result.result == expected_succ
-    assert ppe_result.failure == expected_fail
+    with ProcessPoolExecutor(PPEConfig(parallelism=4)) as ppe:
+        ppe_result = mapreduce(simple_f, input_seq, ppe)
+        assert ppe_result.result == expected
+        assert ppe_result.failure == []
+
+        ppe_result = mapreduce(simple_f, seq_with_error, ppe)
+        assert ppe_result.result == expected_succ
+        assert ppe_result.failure == expected_fail
+
+    # the worker-side wrapper does not let the tracebacks of a re-raised exception pile up
+    for _ in range(2):
+        assert _attempt(simple_f, 0, 10).failure == expected_fail
+    assert _error.__traceback__ is None
+
+
+def test_mapreduce_timeout():
+    seq_with_slow = [1, 10, 2, 3, 4, 5]
+    expected_succ = msum((slow_f(e) for e in seq_with_slow if e <= 9), AMonoid)
+
+    ppt = ProcessPerTask(PPTConfig(parallelism=2, task_timeout_s=2))
+    ppt_result = mapreduce(slow_f, seq_with_slow, ppt)
+    assert ppt_result.result == expected_succ
+    assert [e.origin for e in ppt_result.failure] == ["timed out with arg 10"]
+
+    # simultaneous timeouts
+    ppt_result = mapreduce(slow_f, [10, 11, 1], ppt)
+    assert ppt_result.result == slow_f(1)
+    assert sorted(e.origin for e in ppt_result.failure) == ["timed out with arg 10", "timed out with arg 11"]
+
+
+def test_mapreduce_result_transport():
+    seq_with_error = [1, 2, 10]
+    expected_succ = msum((simple_f(e) for e in seq_with_error[:2]), AMonoid)
+    expected_fail = [Failure("failure with args 10", _error)]
+
+    for transport in ("shm", "file"):
+        ppt = ProcessPerTask(PPTConfig(parallelism=2, task_timeout_s=10, result_transport=transport))
+        ppt_result = mapreduce(simple_f, seq_with_error, ppt)
+        assert ppt_result.result == expected_succ
+        assert ppt_result.failure == expected_fail
+
+
+def test_mapreduce_result_transport_release(tmp_path, monkeypatch):
+    # results still in flight when the computation gets interrupted are released as well
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    ppt = ProcessPerTask(PPTConfig(parallelism=2, task_timeout_s=10, result_transport="file", mp_context="fork"))
+    with pytest.raises(ValueError):
+        mapreduce(simple_f, interrupted_seq(), ppt)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_mapreduce_worker_crash():
+    seq_with_crash = [1, 11, 2, 3]
+    expected_succ = msum((crashing_f(e) for e in seq_with_crash if e <= 9), AMonoid)
+
+    # detected on the worker exit, way before the timeout
+    ppt = ProcessPerTask(PPTConfig(parallelism=2, task_timeout_s=60))
+    start = time.monotonic()
+    ppt_result = mapreduce(crashing_f, seq_with_crash, ppt)
+    assert time.monotonic() - start < 30
+    assert ppt_result.result == expected_succ
+    assert [e.origin for e in ppt_result.failure] == ["worker exited with code 11 with arg 11"]
+
+
+def test_mapreduce_retries():
+    input_seq = [1, 2, 3]
+    expected = msum((AMonoid(a=e * 2) for e in input_seq), AMonoid)
+
+    with ProcessPoolExecutor(PPEConfig(parallelism=2, task_retries=1)) as ppe:
+        ppe_result = mapreduce(flaky_f, input_seq, ppe)
+        assert ppe_result.result == expected
+        assert sorted(e.origin for e in ppe_result.failure) == [f"failure with args {e}" for e in input_seq]
+
+
+def test_mapreduce_persistent_pool():
+    input_seq = [1, 2, 3]
+    expected = msum((simple_f(e) for e in input_seq), AMonoid)
+
+    with ProcessPoolExecutor(PPEConfig(parallelism=2)) as ppe:
+        assert mapreduce(simple_f, input_seq, ppe).result == expected
+        pool = ppe._pool
+        assert mapreduce(simple_f, input_seq, ppe).result == expected
+        assert ppe._pool is pool
+        # an interrupted computation does not leave its tasks occupying the pool
+        with pytest.raises(ValueError):
+            mapreduce(simple_f, interrupted_seq(), ppe)
+        assert ppe._pool is None
+        assert mapreduce(simple_f, input_seq, ppe).result == expected
+    assert ppe._pool is None
+
+
+def test_mapreduce_chunksize():
+    seq_with_error = [1, 2, 10, 3, 4]
+    expected_succ = msum((simple_f(e) for e in seq_with_error if e <= 9), AMonoid)
+
+    with ProcessPoolExecutor(PPEConfig(parallelism=2, chunksize=2)) as ppe:
+        ppe_result = mapreduce(simple_f, iter(seq_with_error), ppe)
+        assert ppe_result.result == expected_succ
+        assert ppe_result.failure == [Failure("failure with args 10", _error)]
+
+
+def test_mapreduce_tree_reduce():
+    input_seq = [e % 10 for e in range(100)]
+    expected = msum((simple_f(e) for e in input_seq), AMonoid)
+
+    with ProcessPoolExecutor(PPEConfig(parallelism=2, tree_reduce=True)) as ppe:
+        assert mapreduce(simple_f, input_seq, ppe).result == expected
+        # unsized input yields single-task chunks, and thus many partials
+        ppe_result = mapreduce(simple_f, iter(input_seq + [10]), ppe)
+        assert ppe_result.result == expected
+        assert ppe_result.failure == [Failure("failure with args 10", _error)]
+
+
+def test_mapreduce_initializer():
+    input_seq = [1, 2, 3]
+    expected = msum((AMonoid(a=e + 100) for e in input_seq), AMonoid)
+
+    ppt = ProcessPerTask(PPTConfig(parallelism=2, task_timeout_s=10, initializer=set_offset, initargs=(100,)))
+    assert mapreduce(offset_f, input_seq, ppt).result == expected
+
+    with ProcessPoolExecutor(PPEConfig(parallelism=2, initializer=set_offset, initargs=(100,))) as ppe:
+        assert mapreduce(offset_f, input_seq, ppe).result == expected
+        # a function other than the installed one is shipped with the tasks
+        assert mapreduce(simple_f, input_seq, ppe).result == msum((simple_f(e) for e in input_seq), AMonoid)
+
+    # a failing initializer fails all the tasks instead of the pool restarting the workers forever
+    with ProcessPoolExecutor(PPEConfig(parallelism=2, initializer=failing_init)) as ppe:
+        ppe_result = mapreduce(offset_f, input_seq, ppe)
+        assert ppe_result.result is None
+        assert sorted(e.origin for e in ppe_result.failure) == [f"initializer failure with args {e}" for e in input_seq]
+
+    # the initialization does not count against the timeout of the first task of a worker
+    input_seq = [1, 2, 3, 4, 5, 6]
+    ppt = ProcessPerTask(PPTConfig(parallelism=2, task_timeout_s=1, initializer=slow_set_offset, initargs=(100,)))
+    ppt_result = mapreduce(offset_f, input_seq, ppt)
+    assert ppt_result.result == msum((AMonoid(a=e + 100) for e in input_seq), AMonoid)
+    assert ppt_result.failure == []
+
+
+def test_mapreduce_fail_fast():
+    seq_with_error = [10] + [1] * 50
+    expected_fail = [Failure("failure with args 10", _error)]
+
+    with ProcessPoolExecutor(PPEConfig(parallelism=2, fail_fast=True)) as ppe:
+        ppe_result = mapreduce(sleepy_f, seq_with_error, ppe)
+        assert ppe_result.failure == expected_fail
+        assert ppe_result.result is None or ppe_result.result.a < 100
+        # the pool gets restarted afterwards
+        assert mapreduce(simple_f, [1, 2], ppe).result == AMonoid(a=6)
+
+    # the input is pulled only as the tasks complete, so even an infinite one stops at the failure
+    with ProcessPoolExecutor(PPEConfig(parallelism=2, fail_fast=True, chunksize=1)) as ppe:
+        ppe_result = mapreduce(simple_f, count(), ppe)
+        # any of the chunks in flight past 9 may be the first to fail
+        assert [e.origin for e in ppe_result.failure] in ([f"failure with args {a}"] for a in range(10, 14))
+
+
+def test_mapreduce_speculative_execution(tmp_path):
+    marker = str(tmp_path / "marker")
+    seq_with_straggler = [(10, marker)] + [(1, marker)] * 19
+    expected = msum((AMonoid(a=a * 2) for a, _ in seq_with_straggler), AMonoid)
+
+    # the copy finishes way before the original would, and the original is not reported as a failure
+    ppt = ProcessPerTask(PPTConfig(parallelism=2, task_timeout_s=30, speculative_execution=True))
+    start = time.monotonic()
+    ppt_result = mapreduce(straggling_f, seq_with_straggler, ppt)
+    assert time.monotonic() - start < 5
+    assert ppt_result.result == expected
+    assert ppt_result.failure == []
+
+
+def test_mapreduce_speculative_execution_wakeups(monkeypatch):
+    waits = []
+
+    def counting_wait(*args, **kwargs):
+        waits.append(kwargs.get("timeout"))
+        return wait(*args, **kwargs)
+
+    monkeypatch.setattr(process_per_task, "wait", counting_wait)
+    seq_with_slow = [10] + [1] * 19
+
+    # both copies of the straggler time out -- meanwhile, the main loop must sleep instead of spinning
+    ppt = ProcessPerTask(PPTConfig(parallelism=3, task_timeout_s=2, speculative_execution=True))
+    ppt_result = mapreduce(slow_f, seq_with_slow, ppt)
+    assert ppt_result.result == msum((slow_f(e) for e in seq_with_slow[1:]), AMonoid)
+    assert [e.origin for e in ppt_result.failure] == ["timed out with arg 10"]
+    assert len(waits) < 100